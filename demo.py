@@ -24,30 +24,19 @@ groups = 2
 # The initial assignment expectations should be random, and must sum to 1 across
 # each row. There should be no identical entries in a given row.
 initial_assignments = 0.5 + 0.1 * (np.random.random((6,groups)) - 0.5)
-row_sum = np.tile(initial_assignments.sum(1), (groups, 1)).T
-initial_assignments = initial_assignments/row_sum
+initial_assignments /= initial_assignments.sum(axis=1, keepdims=True)
 
 # This is the state of our annealling.
 annealer = AssignmentAnnealing(assignment_iteration(distances), initial_assignments, 0.73)
 
-# Tolerance for deciding when to lower the temperature. We also need to keep
-# track of the old assignments.
+# Tolerance for deciding when to lower the temperature.
 tolerance = 1e-6
-old_assignments = initial_assignments
 
 # For the sake of simplicity, I've picked an arbitrary number of temperature
-# steps.
-for _ in range(20):
-    # Iterating over the annealer object produces the new assignment
-    # expectations.
-    for new_assignments in annealer:
-        # If none of the assignments change by more than the tolerance, drop the
-        # temperature.
-        if np.abs(new_assignments - old_assignments).max() < tolerance:
-            break
-        old_assignments = new_assignments
-    # Next temperature.
-    annealer.cool()
+# steps. At each one the annealer iterates until none of the assignments change
+# by more than the tolerance (or it gives up after 1000 iterations), then drops
+# the temperature.
+annealer.run(20, 1000, tolerance)
 
 # The raw assignment expectation values.
 print("Raw assignment expectations:")
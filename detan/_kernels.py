@@ -0,0 +1,132 @@
+# Copyright 2016 Jason Heeris <jason.heeris@gmail.com>
+#
+# This library is licensed under the 3-clause BSD license distributed with this
+# software.
+
+# Compiled parts of the fixed point iteration in detan.detan. The O(n²k) product
+# of the distance and assignment matrices is left to numpy (and so to BLAS),
+# which no hand-written loop here can match beyond the smallest problems. What
+# remains is O(nk), but in numpy it takes half a dozen separate operations, each
+# with its own dispatch overhead and pass over memory; for the small matrices
+# typical of pairwise clustering that overhead dominates, so those operations
+# are fused into one pass here. numba is an optional dependency: if it isn't
+# installed, HAVE_NUMBA is False and callers should fall back to the numpy
+# implementation.
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+HAVE_NUMBA = numba is not None
+
+
+# Every fast-math flag except the ones that assume there are no NaN or infinite
+# values, since the callers rely on NaN showing up in the results.
+_FASTMATH = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+
+def _jit(**options):
+    # Compiles the decorated function with numba's nopython mode if numba is
+    # available, otherwise leaves it as (slow, but correct) Python. Division by
+    # zero follows numpy (inf or NaN) rather than raising ZeroDivisionError.
+    def decorate(function):
+        if numba is None:
+            return function
+        return numba.njit(error_model='numpy', **options)(function)
+    return decorate
+
+
+@_jit(cache=True, fastmath=_FASTMATH)
+def expectations(M, DM, T):
+    # The rest of assignment_potential() followed by assignment_expectations(),
+    # given the product D·M. The result is written over (and returned as) DM,
+    # which must not be the same array as M.
+    n, k = M.shape
+
+    # Diagonal of Mᵀ·D·M, and the column sums of M.
+    diag_mdm = np.zeros(k)
+    col_sum = np.zeros(k)
+    for i in range(n):
+        for l in range(k):
+            diag_mdm[l] += M[i, l] * DM[i, l]
+            col_sum[l] += M[i, l]
+
+    neg_inv_T = -1.0 / T
+
+    for i in range(n):
+        # Potentials for this row, scaled straight to softmax exponents.
+        for l in range(k):
+            sum_M1 = col_sum[l] - M[i, l]
+            potential = (DM[i, l] - diag_mdm[l] / (2 * sum_M1)) / (sum_M1 + 1)
+            DM[i, l] = potential * neg_inv_T
+
+        if k == 2:
+            # With two clusters the softmax is a logistic function of the
+            # difference between the exponents, which needs only one exp().
+            # Both entries are computed from it (rather than one as 1 minus
+            # the other) so the smaller one keeps its full relative precision.
+            difference = DM[i, 1] - DM[i, 0]
+            ratio = np.exp(-abs(difference))
+            larger = 1.0 / (1.0 + ratio)
+            smaller = ratio * larger
+            if difference > 0:
+                DM[i, 0] = smaller
+                DM[i, 1] = larger
+            else:
+                DM[i, 0] = larger
+                DM[i, 1] = smaller
+            continue
+
+        # Max-shifted softmax across the row.
+        row_max = DM[i, 0]
+        for l in range(1, k):
+            if DM[i, l] > row_max:
+                row_max = DM[i, l]
+
+        total = 0.0
+        for l in range(k):
+            DM[i, l] = np.exp(DM[i, l] - row_max)
+            total += DM[i, l]
+
+        inv_total = 1.0 / total
+        for l in range(k):
+            DM[i, l] *= inv_total
+
+    return DM
+
+
+@_jit(cache=True)
+def expectations_batch(M, DM, T):
+    # expectations() for each restart in a (restarts, n, k) stack of
+    # assignments.
+    for r in range(M.shape[0]):
+        expectations(M[r], DM[r], T)
+    return DM
+
+
+@_jit(cache=True)
+def max_abs_diff_exceeds(a, b, tol):
+    # True as soon as any element of a and b differ by tol or more (or either
+    # is NaN), without forming the difference array. Both must be 2-D arrays of
+    # the same shape.
+    n, k = a.shape
+    for i in range(n):
+        for l in range(k):
+            if not abs(a[i, l] - b[i, l]) < tol:
+                return True
+    return False
+
+
+@_jit(cache=True)
+def has_nan(a):
+    # True as soon as any element of the 2-D array a is NaN, without forming the
+    # boolean array that np.isnan(a).any() would.
+    n, k = a.shape
+    for i in range(n):
+        for l in range(k):
+            if np.isnan(a[i, l]):
+                return True
+    return False
@@ -3,9 +3,37 @@
 # This library is licensed under the 3-clause BSD license distributed with this
 # software.
 
+import functools
+import sys
+
 import numpy as np
 
-def assignment_potential(assignments, distances):
+from . import _kernels
+
+# If true, the closure from assignment_iteration() scans every entry of each new
+# assignment matrix for NaN. By default only the first entry (of each restart)
+# is checked on every iteration. That catches NaN that has spread through the
+# column sums to the whole matrix, but not NaN confined to a few rows (eg. the
+# 0/0 from a cluster collapsing onto a single row); AssignmentAnnealing checks
+# every entry whenever it stashes its state, so such NaN can't be stashed.
+_STRICT_NAN_CHECK = False
+
+def _cupy():
+    # Returns the cupy module if something has already imported it, otherwise
+    # None. There can't be any CuPy arrays before then, and importing it here
+    # would make importing this module much slower for everyone else.
+    return sys.modules.get('cupy')
+
+
+def _array_module(*arrays):
+    # Returns cupy if any of the arrays are on a GPU, otherwise numpy.
+    cupy = _cupy()
+    if cupy is None:
+        return np
+    return cupy.get_array_module(*arrays)
+
+
+def assignment_potential(assignments, distances, out=None):
     """
     This calculates the potentials (the 'ε*[i,λ]') from the assignment
     expectations matrix for deterministic annealing.
@@ -14,52 +42,221 @@ def assignment_potential(assignments, distances):
     and the distance matrix must be symmetric and contain only zeros on the
     diagonal.
 
+    The assignments may also be a stack of assignment matrices with shape
+    (restarts, n, k), in which case the potentials for every restart are
+    calculated at once.
+
     :param assignments: assignment expectations
     :param distances: pairwise distance matrix
+    :param out: (optional) a C-contiguous array of the same shape and type as
+      the result to write the potentials into; it must not be `assignments`
     :return: assignment potentials
     """
-    n, k = assignments.shape
-    mdm = (assignments.T).dot(distances).dot(assignments)
-    sum_M1 = np.outer(np.ones((n,)), assignments.sum(0)) - assignments
-
-    sum_outer = (
-          distances.dot(assignments)
-        - (1 / (2 * sum_M1)) * np.outer(np.ones((n,)), np.diag(mdm))
-    )
-
-    potential = (1 / (sum_M1 + 1)) * sum_outer
+    xp = _array_module(assignments, distances)
+    DM = xp.matmul(distances, assignments, out=out)
+
+    # Only the diagonal of Mᵀ·D·M is needed, so contract it directly from D·M
+    # instead of forming the whole k×k product and discarding most of it.
+    diag_mdm = xp.einsum('...il,...il->...l', assignments, DM)
+    sum_M1 = assignments.sum(-2, keepdims=True) - assignments
+
+    # The potential is (D·M - diag(MᵀDM) / 2(ΣM - M)) / (ΣM - M + 1), built up
+    # in place over D·M.
+    correction = xp.multiply(sum_M1, 2)
+    xp.divide(diag_mdm[..., None, :], correction, out=correction)
+
+    potential = DM
+    potential -= correction
+    sum_M1 += 1
+    potential /= sum_M1
     return potential
 
 
-def assignment_expectations(potentials, T):
+def assignment_expectations(potentials, T, out=None):
     """
-    Calculates assignment expectations (the 〈M[i,λ]〉) from assignment potentials
+    Calculates assignment expectations (the 〈M[i,λ]〉) from assignment potentials
     for deterministic annealing.
 
+    This is a softmax of `-potentials / T` across each row (equivalent to
+    :func:`scipy.special.softmax`, but working in place and on CuPy arrays). It
+    is computed stably, so it cannot produce NaN entries unless the potentials
+    already contain NaN or infinite values.
+
     :param potentials: the assignment potentials (any real numbers)
     :param T: the Lagrangian parameter (temperature) for deterministic annealing
       (strictly greater than zero)
+    :param out: (optional) an array of the same shape as `potentials` to write
+      the expectations into; this may be `potentials` itself
+    :return: assignment expectations
+    """
+    # Shifting each row by its maximum leaves the normalised result unchanged,
+    # but keeps np.exp() from overflowing (or underflowing every entry in a
+    # row to zero) at low temperatures. Scaling by reciprocals means one
+    # division per row (and one for T) rather than one per entry.
+    xp = _array_module(potentials)
+    exponents = xp.multiply(potentials, -1.0 / T, out=out)
+    exponents -= exponents.max(-1, keepdims=True)
+    exp_potential = xp.exp(exponents, out=exponents)
+    exp_potential *= 1.0 / exp_potential.sum(-1, keepdims=True)
+    return exp_potential
+
+
+def assignment_cost(assignments, distances):
+    """
+    Calculates the pairwise clustering cost of the assignment expectations,
+
+        H = ½ Σ_λ (Σ_ij M[i,λ] M[j,λ] D[i,j]) / (Σ_i M[i,λ])
+
+    which deterministic annealing aims to minimise. This can be used to choose
+    between the results of several restarts.
+
+    :param assignments: assignment expectations, or a stack of them with shape
+      (restarts, n, k)
+    :param distances: pairwise distance matrix
+    :return: the cost, or an array of the cost for each restart
     """
-    exp_potential = np.exp(-potentials/T)
-    potentials    = exp_potential / np.outer(exp_potential.sum(1), np.ones((1, potentials.shape[1])))
-    return potentials
+    xp = _array_module(assignments, distances)
+    DM = xp.matmul(distances, assignments)
+    diag_mdm = xp.einsum('...il,...il->...l', assignments, DM)
+    return (diag_mdm / (2 * assignments.sum(-2))).sum(-1)
 
 
-def assignment_iteration(distances):
+def assignment_iteration(distances, reuse_buffers=False, dtype=np.float64):
     """
     Composition of :func:`assignment_potential` and
     :func:`assignment_expectations` suitable for fixed point iteration. This
-    will raise an exception if the assignment matrix contains any NaN entries.
+    will raise an exception if the assignment matrix contains NaN entries. To
+    keep this cheap, only the first entry is checked, so NaN in other rows may
+    go unnoticed until :meth:`AssignmentAnnealing.cool()`, which checks every
+    entry.
+
+    By default every call returns a newly allocated array. If `reuse_buffers`
+    is true, the closure instead alternates between two arrays of its own, so
+    that nothing is allocated once it is running. In that case a returned
+    array is only valid until the call after next (ie. the previous result may
+    still be compared against the current one), and the closure must not be
+    given an array it returned two calls ago.
+
+    The closure accepts either a single (n, k) assignment matrix or a stack of
+    them with shape (restarts, n, k); in the latter case every restart is
+    iterated in the same call.
+
+    The distances are converted to `dtype`, and assignments of any other type
+    are converted to it before each step (:class:`AssignmentAnnealing` uses the
+    same type automatically, so this costs nothing there). Single precision
+    halves the memory traffic of each step and is usually accurate enough for
+    annealing, but the convergence tolerance should then be no smaller than
+    about 1e-5.
+
+    If `numba <http://numba.pydata.org/>`_ is installed, the product of the
+    distance and assignment matrices is still formed by numpy, but everything
+    after it is fused into a single compiled pass. This saves the overhead of
+    the separate numpy operations, which dominates when n is in the tens or
+    hundreds (making a step roughly two to four times faster). For large n the
+    O(n²k) product dominates instead and both ways cost about the same.
+    Otherwise the numpy implementations are used directly.
+
+    If `distances` is a `CuPy <https://cupy.dev/>`_ array, the iteration is done
+    on the GPU with CuPy instead, and the assignments must also be CuPy arrays
+    (see :meth:`AssignmentAnnealing.to_gpu()`). This is worthwhile for large
+    problems, where the O(n²k) product of the distance and assignment matrices
+    dominates. To keep the iteration from waiting on the GPU, the closure does
+    not check for NaN in this case; NaN is only detected by
+    :meth:`AssignmentAnnealing.cool()`.
     """
+    xp = _array_module(distances)
+    distances = xp.ascontiguousarray(distances, dtype=dtype)
+
+    # The implementation is picked once, here, so the closure itself is just a
+    # call into either the compiled kernel or the numpy functions.
+    if _kernels.HAVE_NUMBA and xp is np:
+        def step_into(assignments, T, out):
+            DM = np.matmul(distances, assignments, out=out)
+            if assignments.ndim == 3:
+                return _kernels.expectations_batch(assignments, DM, T)
+            return _kernels.expectations(assignments, DM, T)
+
+        step = functools.partial(step_into, out=None)
+
+        def converge(assignments, T, max_iters, tol):
+            # Repeats the step at a fixed temperature until no entry changes by
+            # tol or more, or max_iters iterations have been done, alternating
+            # between two buffers. Returns the last assignments computed, the
+            # number of iterations and whether they stayed free of NaN; if not,
+            # the assignments are those from before the NaN appeared.
+            current = np.array(assignments, dtype=distances.dtype)
+            following = np.empty_like(current)
+
+            for iteration in range(max_iters):
+                step_into(current, T, following)
+
+                if not _kernels.max_abs_diff_exceeds(following, current, tol):
+                    return following, iteration + 1, True
+
+                # NaN never counts as converged, so it only needs looking for
+                # once the step is known not to have converged.
+                if _kernels.has_nan(following):
+                    return current, iteration, False
+
+                current, following = following, current
+
+            return current, max_iters, True
+    else:
+        def step(assignments, T):
+            potentials = assignment_potential(assignments, distances)
+            return assignment_expectations(potentials, T, out=potentials)
+
+        def step_into(assignments, T, out):
+            potentials = assignment_potential(assignments, distances, out=out)
+            return assignment_expectations(potentials, T, out=potentials)
+
+    buffers = []
+
+    def reusing_step(assignments, T):
+        # The compiled kernel has no bounds checks, so the buffers must match
+        # the input exactly; they are replaced if it changes shape.
+        if not buffers or buffers[0].shape != assignments.shape:
+            buffers[:] = [
+                xp.empty(assignments.shape, dtype=dtype) for _ in range(2)
+            ]
+
+        # Write into whichever buffer isn't being read from.
+        out = buffers[1] if assignments is buffers[0] else buffers[0]
+        return step_into(assignments, T=T, out=out)
+
+    if reuse_buffers:
+        step = reusing_step
+
     def closure(assignments, T):
-        potentials = assignment_potential(assignments, distances)
-        new_assignments = assignment_expectations(potentials, T)
+        if assignments.dtype != distances.dtype:
+            assignments = xp.asarray(assignments, dtype=distances.dtype)
+
+        new_assignments = step(assignments, T)
+
+        # On the GPU, any check here means waiting for the device and copying
+        # the result back on every iteration, so it's left to the full check
+        # when AssignmentAnnealing stashes its state.
+        if xp is not np and not _STRICT_NAN_CHECK:
+            return new_assignments
+
+        if _STRICT_NAN_CHECK:
+            invalid = xp.isnan(new_assignments).any()
+        else:
+            invalid = xp.isnan(new_assignments[..., 0, 0]).any()
 
-        if np.isnan(new_assignments).any():
+        if invalid:
             raise ValueError("NaN in computed assignment expectations")
 
         return new_assignments
 
+    # AssignmentAnnealing takes its default dtype from this.
+    closure.dtype = distances.dtype
+
+    # AssignmentAnnealing.run() uses this to do a whole temperature step without
+    # going through the closure (for a single assignment matrix only).
+    if _kernels.HAVE_NUMBA and xp is np:
+        closure.converge = converge
+
     return closure
 
 
@@ -78,7 +275,7 @@ class AssignmentAnnealing:
         M = 1 - np.random.random((n ,k))
 
         # Normalise the assignments so each row sum is 1
-        M = M/np.tile(M.sum(1), (k, 1)).T
+        M /= M.sum(axis=1, keepdims=True)
 
         # Create deterministic annealing state
         annealer = AssignmentAnnealing(iterator_function, M, 0.73)
@@ -86,10 +283,13 @@ class AssignmentAnnealing:
         # Tolerance for convergence
         tolerance = 1e-6
 
+        old_assignments = M
+
         for temperature_steps in range(20):
             for new_assignments in annealer:
-                if (new_assignments - old_assignments).abs().max() < tolerance:
+                if annealer.converged(old_assignments, tolerance):
                     break
+                old_assignments = new_assignments
             annealer.cool()
 
         print(np.round(annealer.assignments).astype(int))
@@ -104,6 +304,13 @@ class AssignmentAnnealing:
                 next(annealer)
             annealer.cool()
 
+    ...or, to do a fixed number of iterations without going through the
+    iterator protocol each time, :meth:`next_k()`::
+
+        for temperature_steps in range(20):
+            annealer.next_k(20)
+            annealer.cool()
+
     The :meth:`cool()` method will lower the
     temperature by the ratio given in the constructor.
 
@@ -116,6 +323,21 @@ class AssignmentAnnealing:
     remembered temperature and assignments, and the caller can then eg. change
     the ratio, or take some other action to continue annealing.
 
+    Since deterministic annealing is sensitive to the initial assignments, it
+    is common to anneal from several random starting points and keep the best
+    result. The initial assignments may be given as a stack with shape
+    (restarts, n, k) to do all of them at once, as long as the iteration
+    function supports it (the one from :func:`assignment_iteration` does). The
+    annealer then only counts as converged once every restart has, and
+    :meth:`best_restart()` picks out the final result::
+
+        M = 1 - np.random.random((restarts, n, k))
+        M /= M.sum(axis=2, keepdims=True)
+
+        annealer = AssignmentAnnealing(assignment_iteration(D), M, 0.73)
+        annealer.run(20, 1000, 1e-6)
+        best = annealer.best_restart(D)
+
     The `ratio` member is a part of the API and can be changed at any time. It
     must always be strictly between 0 and 1. It has the same meaning as the
     `ratio` parameter in the constructor.
@@ -124,7 +346,10 @@ class AssignmentAnnealing:
     only read from.
     """
 
-    def __init__(self, function, initial_assignments, temperature_ratio):
+    def __init__(
+        self, function, initial_assignments, temperature_ratio,
+        dtype=None
+    ):
         """
         Create a new deterministic annealing state. The given function should
         have the interface::
@@ -150,9 +375,31 @@ class AssignmentAnnealing:
           expectations (usually a random assignment)
         :param temperature_ratio: a number strictly between 0 and 1; at each
           step, the temperature will be lowered by this factor
+        :param dtype: the floating point type to hold the assignments in; by
+          default this is the type used by `function` if it came from
+          :func:`assignment_iteration` (any other type is rejected with a
+          :class:`ValueError`), otherwise double precision
         """
+        function_dtype = getattr(function, 'dtype', None)
+        if dtype is None:
+            dtype = np.float64 if function_dtype is None else function_dtype
+        elif function_dtype is not None and np.dtype(dtype) != function_dtype:
+            # Otherwise the result would depend on whether the steps went
+            # through the function (which converts to its own type) or not.
+            raise ValueError("dtype does not match the iteration function's")
+
         self.function = function
-        self.assignments = initial_assignments
+        # The compiled kernels and np.dot() are fastest with row-major arrays.
+        xp = _array_module(initial_assignments)
+        self.assignments = xp.ascontiguousarray(
+            initial_assignments, dtype=dtype
+        )
+
+        # The iteration keeps the rows normalised, and relies on that rather
+        # than re-checking it, so it's only checked once here.
+        row_error = xp.abs(self.assignments.sum(-1) - 1).max()
+        assert (row_error < 1e-3), "Assignment rows do not sum to 1"
+
         self.temperature = 1
         self.ratio = temperature_ratio
         self._stash()
@@ -160,8 +407,24 @@ class AssignmentAnnealing:
 
     def _stash(self):
         # Stores temperature and assignments in case annealing produces NaN
-        # values and the caller wants to back up a step.
-        self._stashed = (self.temperature, self.assignments)
+        # values and the caller wants to back up a step. The assignments are
+        # copied, since the iteration function may reuse the arrays it returns.
+        # This is the end-of-phase check for NaN that the iteration function's
+        # cheaper per-step check can miss, so a stash never contains NaN.
+        xp = _array_module(self.assignments)
+        if xp.isnan(self.assignments).any():
+            raise ValueError("NaN in computed assignment expectations")
+
+        self._stashed_T = self.temperature
+        self._stashed_M = self.assignments.copy()
+
+
+    def _converge_loop(self):
+        # The convergence loop exposed by assignment_iteration()'s closure, if
+        # there is one and it applies to the current assignments.
+        if self.assignments.ndim != 2:
+            return None
+        return getattr(self.function, 'converge', None)
 
 
     def __iter__(self):
@@ -179,10 +442,150 @@ class AssignmentAnnealing:
         return next_assignments
 
 
+    def next_k(self, iterations):
+        """
+        Performs `iterations` steps of fixed point iteration, as if by calling
+        :func:`next(annealer)` that many times, and returns the final
+        assignments. If the iteration function came from
+        :func:`assignment_iteration` and numba is available, the steps alternate
+        between two buffers instead of allocating.
+
+        :param iterations: the number of iterations to do
+        :return: the assignment expectations after the last iteration
+        """
+        converge = self._converge_loop()
+
+        if converge is None:
+            for _ in range(iterations):
+                next(self)
+        else:
+            # With a tolerance of zero, nothing counts as converged, so this
+            # always does the full number of iterations.
+            self.assignments, _, finite = converge(
+                self.assignments, self.temperature, iterations, 0.0
+            )
+            if not finite:
+                raise ValueError("NaN in computed assignment expectations")
+
+        return self.assignments
+
+
+    def converged(self, previous, tolerance):
+        """
+        Returns true if no entry of the current assignments differs from the
+        corresponding entry in `previous` by `tolerance` or more. If numba is
+        available, this stops at the first entry that differs by too much.
+
+        :param previous: an earlier assignment matrix of the same shape, usually
+          the result of the previous iteration (a :class:`ValueError` is raised
+          if the shapes differ)
+        :param tolerance: the largest change allowed in any entry
+        """
+        # The compiled comparison has no bounds checks, and numpy would
+        # broadcast some mismatched shapes without complaint.
+        if previous.shape != self.assignments.shape:
+            raise ValueError("Previous assignments have a different shape")
+
+        xp = _array_module(self.assignments, previous)
+
+        if _kernels.HAVE_NUMBA and xp is np and self.assignments.ndim == 2:
+            return not _kernels.max_abs_diff_exceeds(
+                self.assignments, previous, tolerance
+            )
+        return xp.abs(self.assignments - previous).max().item() < tolerance
+
+
+    def run(self, num_temps, max_iters, tolerance):
+        """
+        Runs a complete annealing schedule: at each of `num_temps`
+        temperatures, iterates until :meth:`converged()` (compared to the
+        previous iteration) or until `max_iters` iterations have been done,
+        then calls :meth:`cool()`. This raises a :class:`ValueError` if an
+        iteration produces NaN entries, or if :meth:`cool()` finds any. The
+        current assignments may then contain NaN, but :meth:`reheat()` can be
+        used as usual to go back to the state from the last temperature step.
+
+        If the iteration function came from :func:`assignment_iteration` and
+        numba is available, each temperature step alternates between two
+        buffers instead of allocating, as :meth:`next_k()` does.
+
+        :param num_temps: the number of temperatures to anneal at
+        :param max_iters: the maximum number of iterations at each
+          temperature (at least 1)
+        :param tolerance: the convergence tolerance
+        :return: a list of the number of iterations done at each temperature
+        """
+        assert (max_iters >= 1), "max_iters is less than 1"
+        converge = self._converge_loop()
+        counts = []
+
+        for _ in range(num_temps):
+            if converge is not None:
+                self.assignments, count, finite = converge(
+                    self.assignments, self.temperature, max_iters, tolerance
+                )
+                if not finite:
+                    raise ValueError("NaN in computed assignment expectations")
+            else:
+                for count in range(1, max_iters + 1):
+                    previous = self.assignments
+                    next(self)
+                    if self.converged(previous, tolerance):
+                        break
+
+            counts.append(count)
+            self.cool()
+
+        return counts
+
+
+    def best_restart(self, distances):
+        """
+        When annealing several restarts at once, returns the assignments of the
+        restart with the lowest :func:`assignment_cost()`. This can't be used
+        with a single (n, k) assignment matrix.
+
+        :param distances: the pairwise distance matrix being clustered
+        :return: the (n, k) assignment expectations of the best restart
+        """
+        assert (self.assignments.ndim == 3), "Assignments are not a stack"
+        costs = assignment_cost(self.assignments, distances)
+        return self.assignments[int(costs.argmin())]
+
+
+    def to_gpu(self):
+        """
+        Moves the assignments (and the remembered assignments used by
+        :meth:`reheat()`) to the GPU as CuPy arrays. The iteration function
+        must also work on the GPU, eg. one made by :func:`assignment_iteration`
+        from a CuPy distance matrix.
+        """
+        try:
+            import cupy
+        except ImportError:
+            raise ImportError("CuPy is required for GPU annealing") from None
+
+        self.assignments = cupy.asarray(self.assignments)
+        self._stashed_M = cupy.asarray(self._stashed_M)
+
+
+    def to_cpu(self):
+        """
+        Moves the assignments (and the remembered assignments used by
+        :meth:`reheat()`) back from the GPU to numpy arrays.
+        """
+        cupy = _cupy()
+        if cupy is not None:
+            self.assignments = cupy.asnumpy(self.assignments)
+            self._stashed_M = cupy.asnumpy(self._stashed_M)
+
+
     def cool(self):
         """
         Reduces the temperature used for further function calls by the
-        user-supplied ratio.
+        user-supplied ratio. This raises a :class:`ValueError` (and leaves the
+        temperature unchanged) if the current assignments contain NaN entries,
+        so that :meth:`reheat()` never restores them.
         """
         assert (self.ratio > 0.0 and self.ratio < 1.0), "Ratio is not in (0, 1)"
         self._stash()
@@ -194,4 +597,5 @@ class AssignmentAnnealing:
         Restores the result and temperature from before the :meth:`cool()`
         method was called.
         """
-        self.temperature, self.assignments = self._stashed
+        self.temperature = self._stashed_T
+        self.assignments = self._stashed_M.copy()
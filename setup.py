@@ -14,4 +14,8 @@ setup(
         'numpy',
         'nose',
     ],
+
+    extras_require = {
+        'jit': ['numba'],
+    },
 )
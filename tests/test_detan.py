@@ -0,0 +1,464 @@
+# Copyright 2016 Jason Heeris <jason.heeris@gmail.com>
+#
+# This library is licensed under the 3-clause BSD license distributed with this
+# software.
+
+import sys
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from detan import _kernels, detan
+from detan.detan import (
+    AssignmentAnnealing, assignment_expectations, assignment_iteration,
+    assignment_potential
+)
+
+
+def random_problem(n, k, seed=0, restarts=None):
+    # A symmetric distance matrix with a zero diagonal, and normalised
+    # assignments close to uniform (as they would be at the start of annealing).
+    rng = np.random.RandomState(seed)
+    distances = rng.random_sample((n, n))
+    distances = distances + distances.T
+    np.fill_diagonal(distances, 0)
+
+    shape = (n, k) if restarts is None else (restarts, n, k)
+    assignments = 0.5 + 0.1 * (rng.random_sample(shape) - 0.5)
+    assignments /= assignments.sum(axis=-1, keepdims=True)
+    return distances, assignments
+
+
+def reference_iteration(assignments, distances, T):
+    # The potential and expectation equations written out directly, as in the
+    # original implementation.
+    n, k = assignments.shape
+    mdm = assignments.T.dot(distances).dot(assignments)
+    sum_M1 = np.outer(np.ones(n), assignments.sum(0)) - assignments
+    sum_outer = (
+          distances.dot(assignments)
+        - (1 / (2 * sum_M1)) * np.outer(np.ones(n), np.diag(mdm))
+    )
+    potentials = sum_outer / (sum_M1 + 1)
+    exp_potential = np.exp(-potentials / T)
+    return exp_potential / exp_potential.sum(1)[:, None]
+
+
+def collapsing_problem():
+    # Cluster 2 holds only row 3, so that row's (ΣM - M) is exactly zero and its
+    # potential is 0/0. The NaN stays in row 3 rather than spreading.
+    distances, assignments = random_problem(6, 3)
+    assignments[:, :2] = 0.5
+    assignments[:, 2] = 0
+    assignments[3] = (0, 0, 1)
+    return distances, assignments
+
+
+class BothPaths:
+    # Mixin for running checks with the numba kernels (when numba is installed)
+    # and with the numpy implementation.
+
+    def for_each_path(self, check):
+        for compiled in ([True, False] if _kernels.HAVE_NUMBA else [False]):
+            with self.subTest(compiled=compiled), \
+                    mock.patch.object(_kernels, 'HAVE_NUMBA', compiled):
+                check()
+
+
+class TestIteration(BothPaths, unittest.TestCase):
+
+    def test_matches_reference(self):
+        def check():
+            for k in (2, 3, 5):
+                distances, assignments = random_problem(12, k)
+                closure = assignment_iteration(distances)
+                for T in (1.0, 0.1):
+                    np.testing.assert_allclose(
+                        closure(assignments, T),
+                        reference_iteration(assignments, distances, T),
+                        rtol=1e-12, atol=1e-15
+                    )
+
+        self.for_each_path(check)
+
+    def test_matches_numpy_functions(self):
+        def check():
+            for k in (2, 4):
+                distances, assignments = random_problem(9, k, seed=k)
+                potentials = assignment_potential(assignments, distances)
+                np.testing.assert_allclose(
+                    assignment_iteration(distances)(assignments, 0.3),
+                    assignment_expectations(potentials, 0.3),
+                    rtol=1e-12, atol=1e-15
+                )
+
+        self.for_each_path(check)
+
+    def test_two_clusters_small_entries(self):
+        # At a low temperature the smaller expectation in each row is tiny, and
+        # should still match to full relative precision rather than being lost
+        # in a subtraction from 1.
+        def check():
+            distances, assignments = random_problem(9, 2, seed=3)
+            assignments[:, 0] = np.linspace(0.2, 0.8, 9)
+            assignments[:, 1] = 1 - assignments[:, 0]
+            potentials = assignment_potential(assignments, distances)
+            result = assignment_iteration(distances)(assignments, 0.001)
+            self.assertLess(result.min(), 1e-20)
+            np.testing.assert_allclose(
+                result, assignment_expectations(potentials, 0.001), rtol=1e-9
+            )
+
+        self.for_each_path(check)
+
+    def test_rows_normalised(self):
+        def check():
+            distances, assignments = random_problem(10, 3)
+            result = assignment_iteration(distances)(assignments, 0.05)
+            np.testing.assert_allclose(result.sum(1), 1.0)
+
+        self.for_each_path(check)
+
+    def test_batch_matches_single(self):
+        def check():
+            for k in (2, 3):
+                distances, assignments = random_problem(8, k, restarts=4)
+                closure = assignment_iteration(distances)
+                single = np.stack([closure(M, 0.5) for M in assignments])
+                np.testing.assert_allclose(
+                    closure(assignments, 0.5), single, rtol=1e-12
+                )
+                np.testing.assert_allclose(
+                    assignment_potential(assignments, distances),
+                    np.stack([
+                        assignment_potential(M, distances) for M in assignments
+                    ]),
+                    rtol=1e-12
+                )
+
+        self.for_each_path(check)
+
+    def test_reused_buffers(self):
+        def check():
+            distances, assignments = random_problem(8, 3)
+            fresh = assignment_iteration(distances)
+            reusing = assignment_iteration(distances, reuse_buffers=True)
+
+            a = b = assignments
+            returned = set()
+            for _ in range(10):
+                a = fresh(a, 0.5)
+                b = reusing(b, 0.5)
+                returned.add(id(b))
+            np.testing.assert_array_equal(a, b)
+            self.assertEqual(len(returned), 2)
+
+        self.for_each_path(check)
+
+    def test_reused_buffers_follow_shape(self):
+        def check():
+            distances, _ = random_problem(6, 2)
+            fresh = assignment_iteration(distances)
+            reusing = assignment_iteration(distances, reuse_buffers=True)
+            for k in (2, 4, 2):
+                _, assignments = random_problem(6, k, seed=k)
+                result = reusing(assignments, 1.0)
+                self.assertEqual(result.shape, (6, k))
+                np.testing.assert_array_equal(result, fresh(assignments, 1.0))
+
+        self.for_each_path(check)
+
+    def test_nan_raises(self):
+        def check():
+            distances, assignments = random_problem(6, 2)
+            assignments[0, 0] = np.nan
+            with self.assertRaises(ValueError):
+                assignment_iteration(distances)(assignments, 1.0)
+
+        self.for_each_path(check)
+
+    def test_strict_nan_check(self):
+        def check():
+            distances, assignments = collapsing_problem()
+            closure = assignment_iteration(distances)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                # Only row 3 is NaN, which the default check doesn't look at.
+                self.assertTrue(np.isnan(closure(assignments, 1.0)).any())
+                with mock.patch.object(detan, '_STRICT_NAN_CHECK', True), \
+                        self.assertRaises(ValueError):
+                    closure(assignments, 1.0)
+
+        self.for_each_path(check)
+
+    def test_dtype(self):
+        def check():
+            distances, assignments = random_problem(6, 2)
+            closure = assignment_iteration(distances, dtype=np.float32)
+            self.assertEqual(closure(assignments, 1.0).dtype, np.float32)
+
+            annealer = AssignmentAnnealing(closure, assignments, 0.7)
+            self.assertEqual(annealer.assignments.dtype, np.float32)
+            annealer.run(3, 100, 1e-5)
+            self.assertEqual(annealer.assignments.dtype, np.float32)
+
+            with self.assertRaises(ValueError):
+                AssignmentAnnealing(closure, assignments, 0.7, np.float64)
+
+        self.for_each_path(check)
+
+
+class TestAnnealing(BothPaths, unittest.TestCase):
+
+    def test_reheat_round_trip(self):
+        def check():
+            distances, assignments = random_problem(8, 3)
+            annealer = AssignmentAnnealing(
+                assignment_iteration(distances, reuse_buffers=True),
+                assignments, 0.7
+            )
+            annealer.next_k(5)
+            annealer.cool()
+            annealer.next_k(5)
+            temperature = annealer.temperature
+            stashed = annealer.assignments.copy()
+
+            annealer.cool()
+            annealer.next_k(5)
+            annealer.reheat()
+            self.assertEqual(annealer.temperature, temperature)
+            np.testing.assert_array_equal(annealer.assignments, stashed)
+
+        self.for_each_path(check)
+
+    def test_collapsing_cluster_not_stashed(self):
+        def check():
+            distances, assignments = collapsing_problem()
+            annealer = AssignmentAnnealing(
+                assignment_iteration(distances), assignments, 0.7
+            )
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                next(annealer)
+            self.assertTrue(np.isnan(annealer.assignments).any())
+
+            with self.assertRaises(ValueError):
+                annealer.cool()
+            self.assertEqual(annealer.temperature, 1)
+
+            annealer.reheat()
+            self.assertFalse(np.isnan(annealer.assignments).any())
+
+        self.for_each_path(check)
+
+    def test_run_raises_on_nan(self):
+        def check():
+            distances, assignments = collapsing_problem()
+            annealer = AssignmentAnnealing(
+                assignment_iteration(distances), assignments, 0.7
+            )
+            with np.errstate(invalid='ignore', divide='ignore'), \
+                    self.assertRaises(ValueError):
+                annealer.run(3, 10, 1e-6)
+
+        self.for_each_path(check)
+
+    def test_run_matches_manual_loop(self):
+        distances, assignments = random_problem(12, 3, seed=1)
+        closure = assignment_iteration(distances)
+
+        compiled = AssignmentAnnealing(closure, assignments, 0.8)
+        compiled_counts = compiled.run(10, 500, 1e-8)
+
+        # Wrapping the closure hides its converge() from run().
+        manual = AssignmentAnnealing(
+            lambda M, T: closure(M, T), assignments, 0.8
+        )
+        manual_counts = manual.run(10, 500, 1e-8)
+
+        self.assertEqual(compiled_counts, manual_counts)
+        np.testing.assert_allclose(
+            compiled.assignments, manual.assignments, atol=1e-12
+        )
+        self.assertEqual(compiled.temperature, manual.temperature)
+
+    def test_run_needs_iterations(self):
+        distances, assignments = random_problem(6, 2)
+        annealer = AssignmentAnnealing(
+            assignment_iteration(distances), assignments, 0.7
+        )
+        with self.assertRaises(AssertionError):
+            annealer.run(1, 0, 1e-6)
+
+    def test_next_k(self):
+        def check():
+            distances, assignments = random_problem(8, 2)
+            closure = assignment_iteration(distances)
+            batched = AssignmentAnnealing(closure, assignments, 0.7)
+            stepped = AssignmentAnnealing(closure, assignments, 0.7)
+
+            batched.next_k(7)
+            for _ in range(7):
+                next(stepped)
+            np.testing.assert_allclose(
+                batched.assignments, stepped.assignments, atol=1e-14
+            )
+
+        self.for_each_path(check)
+
+    def test_converged(self):
+        def check():
+            distances, assignments = random_problem(6, 2)
+            annealer = AssignmentAnnealing(
+                assignment_iteration(distances), assignments, 0.7
+            )
+            self.assertTrue(annealer.converged(assignments, 1e-12))
+            shifted = assignments.copy()
+            shifted[2, 1] += 1e-3
+            self.assertFalse(annealer.converged(shifted, 1e-4))
+            self.assertTrue(annealer.converged(shifted, 1e-2))
+
+            for shape in ((5, 2), (6, 1), (2,)):
+                with self.assertRaises(ValueError):
+                    annealer.converged(np.ones(shape), 1.0)
+
+        self.for_each_path(check)
+
+    def test_assignments_contiguous(self):
+        distances, assignments = random_problem(8, 3)
+        annealer = AssignmentAnnealing(
+            assignment_iteration(distances), np.asfortranarray(assignments),
+            0.7
+        )
+        self.assertTrue(annealer.assignments.flags.c_contiguous)
+        np.testing.assert_array_equal(annealer.assignments, assignments)
+
+    def test_unnormalised_rows_rejected(self):
+        distances, assignments = random_problem(6, 2)
+        assignments[4] *= 1.1
+        with self.assertRaises(AssertionError):
+            AssignmentAnnealing(
+                assignment_iteration(distances), assignments, 0.7
+            )
+
+    def test_best_restart(self):
+        distances, assignments = random_problem(10, 2, restarts=3)
+        annealer = AssignmentAnnealing(
+            assignment_iteration(distances), assignments, 0.73
+        )
+        annealer.run(15, 1000, 1e-6)
+
+        costs = [
+            detan.assignment_cost(M, distances) for M in annealer.assignments
+        ]
+        np.testing.assert_array_equal(
+            annealer.best_restart(distances),
+            annealer.assignments[int(np.argmin(costs))]
+        )
+
+    def test_best_restart_needs_stack(self):
+        distances, assignments = random_problem(10, 2)
+        annealer = AssignmentAnnealing(
+            assignment_iteration(distances), assignments, 0.73
+        )
+        with self.assertRaises(AssertionError):
+            annealer.best_restart(distances)
+
+
+class FakeCupy:
+    # Stands in for both the cupy module and its array module: every array
+    # counts as a "GPU" array, and calls are passed through to numpy. Calls to
+    # isnan() are counted, since on a real GPU each one means a device sync.
+
+    def __init__(self):
+        self.isnan_calls = 0
+
+    def __getattr__(self, name):
+        return getattr(np, name)
+
+    def get_array_module(self, *arrays):
+        return self
+
+    def isnan(self, *args, **kwargs):
+        self.isnan_calls += 1
+        return np.isnan(*args, **kwargs)
+
+    asnumpy = staticmethod(np.asarray)
+
+
+class TestArrayModule(unittest.TestCase):
+
+    def setUp(self):
+        self.xp = FakeCupy()
+        patcher = mock.patch.dict(sys.modules, {'cupy': self.xp})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_iteration_matches_numpy(self):
+        distances, assignments = random_problem(8, 3)
+        closure = assignment_iteration(distances)
+        self.assertFalse(hasattr(closure, 'converge'))
+
+        for T in (1.0, 0.1):
+            np.testing.assert_allclose(
+                closure(assignments, T),
+                reference_iteration(assignments, distances, T),
+                rtol=1e-12, atol=1e-15
+            )
+
+    def test_no_check_per_iteration(self):
+        distances, assignments = random_problem(8, 3)
+        annealer = AssignmentAnnealing(
+            assignment_iteration(distances), assignments, 0.7
+        )
+        calls = self.xp.isnan_calls
+        annealer.next_k(10)
+        self.assertEqual(self.xp.isnan_calls, calls)
+
+        annealer.cool()
+        self.assertEqual(self.xp.isnan_calls, calls + 1)
+
+    def test_nan_caught_by_cool(self):
+        distances, assignments = random_problem(6, 2)
+        annealer = AssignmentAnnealing(
+            assignment_iteration(distances), assignments, 0.7
+        )
+        annealer.assignments = annealer.assignments.copy()
+        annealer.assignments[0, 0] = np.nan
+
+        with np.errstate(invalid='ignore'):
+            next(annealer)
+        with self.assertRaises(ValueError):
+            annealer.cool()
+
+        annealer.reheat()
+        np.testing.assert_array_equal(annealer.assignments, assignments)
+
+    def test_run(self):
+        distances, assignments = random_problem(10, 2, seed=2)
+        on_gpu = AssignmentAnnealing(
+            assignment_iteration(distances), assignments, 0.8
+        )
+        counts = on_gpu.run(5, 500, 1e-8)
+
+        with mock.patch.dict(sys.modules, {'cupy': None}), \
+                mock.patch.object(_kernels, 'HAVE_NUMBA', False):
+            on_cpu = AssignmentAnnealing(
+                assignment_iteration(distances), assignments, 0.8
+            )
+            self.assertEqual(on_cpu.run(5, 500, 1e-8), counts)
+
+        np.testing.assert_allclose(on_gpu.assignments, on_cpu.assignments)
+
+    def test_to_gpu_needs_cupy(self):
+        distances, assignments = random_problem(6, 2)
+        annealer = AssignmentAnnealing(
+            assignment_iteration(distances), assignments, 0.7
+        )
+        with mock.patch.dict(sys.modules, {'cupy': None}), \
+                self.assertRaises(ImportError):
+            annealer.to_gpu()
+
+
+if __name__ == '__main__':
+    unittest.main()